@@ -4,16 +4,42 @@ Few-Shot Prompting Version (No Fine-Tuning Required)
 """
 
 import os
+import re
 import json
-from flask import Flask, request, jsonify
+import time
+import unicodedata
+import hashlib
+import sqlite3
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import numpy as np
+import orjson
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from openai import OpenAI
+from werkzeug.exceptions import BadRequest
+import tiktoken
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson for jsonify() and request.get_json()"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 CORS(app, resources={
     r"/api/*": {
@@ -23,35 +49,107 @@ CORS(app, resources={
     }
 })
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# The SDK retries 429/5xx itself with exponential backoff, jitter and Retry-After
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=5)
 
 # Use standard model (no fine-tuning needed)
 MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.0
+
+# Longer inputs are rejected before any API call (gpt-4o-mini context is 128k)
+MAX_INPUT_TOKENS = 100_000
+
+# Output budget: components quote the input, so scale with input size
+MIN_OUTPUT_TOKENS = 200
+MAX_OUTPUT_TOKENS = 4000
+
+# Batch endpoint limits
+MAX_BATCH_SIZE = 100
+BATCH_CHUNK_SIZE = 10
+BATCH_MAX_TOKENS = 16000
+
+# Concurrency limits for outgoing OpenAI calls (per worker process)
+MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 10))
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 500))
+
+# Every Batch API line repeats the ~9 KB serialized static prefix and the file is
+# built in memory, so stay well below the API's 50,000-line / 200 MB limits
+MAX_BULK_SIZE = 5000
+BULK_FILE_MAX_BYTES = 190 * 1024 * 1024
+
+# Response cache settings
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.db")
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+
+# Semantic cache settings (opt-in: a near-duplicate hit returns components
+# whose "text" was extracted from the earlier, slightly different input)
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_PATH = os.environ.get("SEMANTIC_CACHE_PATH", RESPONSE_CACHE_PATH)
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.97))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 50000))
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_TOKENS = 8191
 
 # Few-shot examples for better accuracy
-FEW_SHOT_EXAMPLES = """
-EXAMPLE 1:
-Input: "This study will be conducted in accordance with Good Clinical Practice (GCP) as defined by the International Council for Harmonisation (ICH) and in accordance with the ethical principles underlying European Union Directive 2001/20/EC."
-Output: [{"type": "boilerplate", "title": "GCP Compliance Statement", "text": "This study will be conducted in accordance with Good Clinical Practice (GCP) as defined by the International Council for Harmonisation (ICH) and in accordance with the ethical principles underlying European Union Directive 2001/20/EC.", "confidence": 0.97, "reuse_potential": "high", "rationale": "Standard regulatory compliance statement used across multiple protocols"}]
-
-EXAMPLE 2:
-Input: "Primary Endpoint: The primary endpoint is overall survival (OS), defined as the time from randomization to death from any cause."
-Output: [{"type": "definition", "title": "Overall Survival Definition", "text": "The primary endpoint is overall survival (OS), defined as the time from randomization to death from any cause.", "confidence": 0.95, "reuse_potential": "high", "rationale": "Standard endpoint definition used in oncology trials"}]
-
-EXAMPLE 3:
-Input: "Inclusion Criteria: 1. Age >= 18 years 2. Histologically confirmed diagnosis 3. ECOG performance status 0-1"
-Output: [{"type": "study_section", "title": "Inclusion Criteria", "text": "1. Age >= 18 years 2. Histologically confirmed diagnosis 3. ECOG performance status 0-1", "confidence": 0.94, "reuse_potential": "medium", "rationale": "Common inclusion criteria structure for clinical trials"}]
-
-EXAMPLE 4:
-Input: "Adverse events will be graded according to NCI-CTCAE version 5.0. All serious adverse events must be reported within 24 hours."
-Output: [{"type": "safety", "title": "Adverse Event Reporting", "text": "Adverse events will be graded according to NCI-CTCAE version 5.0. All serious adverse events must be reported within 24 hours.", "confidence": 0.96, "reuse_potential": "high", "rationale": "Standard safety reporting procedures"}]
-
-EXAMPLE 5:
-Input: "The investigational product is administered orally at 100mg twice daily with food."
-Output: [{"type": "drug_info", "title": "Drug Administration", "text": "The investigational product is administered orally at 100mg twice daily with food.", "confidence": 0.92, "reuse_potential": "medium", "rationale": "Drug dosing information"}]
-"""
+FEW_SHOT_EXAMPLES = [
+    {
+        "input": "This study will be conducted in accordance with Good Clinical Practice (GCP) as defined by the International Council for Harmonisation (ICH) and in accordance with the ethical principles underlying European Union Directive 2001/20/EC.",
+        "components": [{
+            "type": "boilerplate",
+            "title": "GCP Compliance Statement",
+            "text": "This study will be conducted in accordance with Good Clinical Practice (GCP) as defined by the International Council for Harmonisation (ICH) and in accordance with the ethical principles underlying European Union Directive 2001/20/EC.",
+            "confidence": 0.97,
+            "reuse_potential": "high",
+            "rationale": "Standard regulatory compliance statement used across multiple protocols"
+        }]
+    },
+    {
+        "input": "Primary Endpoint: The primary endpoint is overall survival (OS), defined as the time from randomization to death from any cause.",
+        "components": [{
+            "type": "definition",
+            "title": "Overall Survival Definition",
+            "text": "The primary endpoint is overall survival (OS), defined as the time from randomization to death from any cause.",
+            "confidence": 0.95,
+            "reuse_potential": "high",
+            "rationale": "Standard endpoint definition used in oncology trials"
+        }]
+    },
+    {
+        "input": "Inclusion Criteria: 1. Age >= 18 years 2. Histologically confirmed diagnosis 3. ECOG performance status 0-1",
+        "components": [{
+            "type": "study_section",
+            "title": "Inclusion Criteria",
+            "text": "1. Age >= 18 years 2. Histologically confirmed diagnosis 3. ECOG performance status 0-1",
+            "confidence": 0.94,
+            "reuse_potential": "medium",
+            "rationale": "Common inclusion criteria structure for clinical trials"
+        }]
+    },
+    {
+        "input": "Adverse events will be graded according to NCI-CTCAE version 5.0. All serious adverse events must be reported within 24 hours.",
+        "components": [{
+            "type": "safety",
+            "title": "Adverse Event Reporting",
+            "text": "Adverse events will be graded according to NCI-CTCAE version 5.0. All serious adverse events must be reported within 24 hours.",
+            "confidence": 0.96,
+            "reuse_potential": "high",
+            "rationale": "Standard safety reporting procedures"
+        }]
+    },
+    {
+        "input": "The investigational product is administered orally at 100mg twice daily with food.",
+        "components": [{
+            "type": "drug_info",
+            "title": "Drug Administration",
+            "text": "The investigational product is administered orally at 100mg twice daily with food.",
+            "confidence": 0.92,
+            "reuse_potential": "medium",
+            "rationale": "Drug dosing information"
+        }]
+    }
+]
 
-SYSTEM_PROMPT = f"""You are an expert clinical documentation analyst specializing in identifying reusable content components in medical and clinical documents.
+SYSTEM_PROMPT = """You are an expert clinical documentation analyst specializing in identifying reusable content components in medical and clinical documents.
 
 TASK: Analyze clinical text and identify all reusable components.
 
@@ -69,24 +167,600 @@ RULES:
 3. Assign reuse_potential: "high", "medium", or "low"
 4. Provide brief rationale for each component
 
-{FEW_SHOT_EXAMPLES}
-
 OUTPUT FORMAT:
-Return ONLY a valid JSON array with this structure (no other text):
-[{{"type": "component_type", "title": "Descriptive title", "text": "Exact extracted text", "confidence": 0.95, "reuse_potential": "high", "rationale": "Brief explanation"}}]
+Return ONLY a valid JSON object with this structure (no other text):
+{"components": [{"type": "component_type", "title": "Descriptive title", "text": "Exact extracted text", "confidence": 0.95, "reuse_potential": "high", "rationale": "Brief explanation"}]}
+
+Each user message contains only the clinical text to analyze. Identify all reusable components in it.
+"""
+
+# OpenAI only caches prompt prefixes of 1024+ tokens; keep a safety margin
+PROMPT_CACHE_MIN_TOKENS = 1100
+PROMPT_CACHE_MODELS = ("gpt-4o", "gpt-4o-mini", "gpt-4.1")
+
+# Stable filler appended when the prompt is too short to be cached.
+# Never make this dynamic: any per-process difference breaks the cache.
+PROMPT_PADDING = """
+ADDITIONAL GUIDANCE:
+- Prefer fewer, complete components over many fragments; never split a sentence across components.
+- Keep numbered or bulleted lists together as one component when they share a heading.
+- Copy component text exactly as written, including numbering, units, and abbreviations.
+- Use the most specific component type; use "procedure" only when no other type applies.
+- Give lower confidence when a component boundary depends on surrounding context.
+- Rate reuse_potential "high" only for text that would appear unchanged in other protocols.
+- Do not invent components for headings, page numbers, or document metadata.
+- Return an empty components array when the text contains no reusable components.
 """
 
 
+def _load_encoder():
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer for {MODEL}: {e}")
+        return None
+
+
+# Loading the BPE ranks takes tens of milliseconds; do it once per process
+_ENC = _load_encoder()
+
+
+def _count_tokens(text: str) -> int:
+    """Count tokens in text (estimated at ~4 characters per token without a tokenizer)"""
+    if _ENC is None:
+        return len(text) // 4
+    return len(_ENC.encode(text))
+
+
+def _max_output_tokens(input_tokens: int) -> int:
+    """Output budget for one input: roughly two tokens out per token in, plus JSON overhead"""
+    return max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, 2 * input_tokens + 200))
+
+
+def _input_too_long(input_tokens: int):
+    """413 response for inputs that could not fit the model context, else None"""
+    if input_tokens <= MAX_INPUT_TOKENS:
+        return None
+    return jsonify({
+        "error": "Text too long",
+        "tokens": input_tokens,
+        "max_tokens": MAX_INPUT_TOKENS
+    }), 413
+
+
+def _count_message_tokens(messages: list) -> int:
+    # Each chat message carries a few tokens of role/formatting overhead
+    return sum(_count_tokens(m["content"]) + 4 for m in messages)
+
+
+def _build_static_messages(system_prompt: str) -> list:
+    """System prompt followed by the few-shot examples as user/assistant turns"""
+    messages = [{"role": "system", "content": system_prompt}]
+    for example in FEW_SHOT_EXAMPLES:
+        messages.append({"role": "user", "content": example["input"]})
+        messages.append({"role": "assistant", "content": json.dumps({"components": example["components"]})})
+    return messages
+
+
+def _pad_system_prompt(prompt):
+    """Pad the system prompt until the static prefix reaches the provider caching threshold"""
+    if not MODEL.startswith(PROMPT_CACHE_MODELS):
+        logger.warning(f"Model {MODEL} may not support automatic prompt caching")
+    
+    # Without a tokenizer _count_tokens estimates, so padding still applies
+    while _count_message_tokens(_build_static_messages(prompt)) < PROMPT_CACHE_MIN_TOKENS:
+        prompt += PROMPT_PADDING
+    return prompt
+
+
+SYSTEM_PROMPT = _pad_system_prompt(SYSTEM_PROMPT)
+
+# Built once so every request starts with the same byte-identical messages;
+# only the final user message varies
+_STATIC_MESSAGES = _build_static_messages(SYSTEM_PROMPT)
+_SYS_TOKENS = _count_message_tokens(_STATIC_MESSAGES)
+logger.info(f"Static prompt prefix: {_SYS_TOKENS} tokens")
+
+# Derived from the exact prefix bytes, so any change to the prompt, examples or
+# padding invalidates cached responses without a manual version bump
+SYSTEM_PROMPT_VERSION = hashlib.sha256(orjson.dumps(_STATIC_MESSAGES)).hexdigest()[:12]
+
+# Static prompt first, user text last: every request shares a byte-identical
+# prefix, and the cache key pins those requests to the same cache shard
+PROMPT_CACHE_KEY = f"clinical-components-{SYSTEM_PROMPT_VERSION}"
+
+# Semantic entries are only valid for the models and prompt that produced them
+SEMANTIC_NAMESPACE = f"{EMBEDDING_MODEL}|{MODEL}|{SYSTEM_PROMPT_VERSION}"
+
+
+def _purge_semantic_entries(conn) -> int:
+    """Delete expired semantic entries and those of other namespaces, if the table exists"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'semantic_entries'"
+    ).fetchone()
+    if exists is None:
+        return 0
+    return conn.execute(
+        "DELETE FROM semantic_entries WHERE expires_at <= ? OR namespace != ?",
+        (int(time.time()), SEMANTIC_NAMESPACE)
+    ).rowcount
+
+
+class ResponseCache:
+    """SQLite cache of identify results for byte-identical inputs"""
+    
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.enabled = True
+        
+        # A read-only or locked database shouldn't stop the service, only its caching
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        components_json BLOB NOT NULL,
+                        usage_json BLOB NOT NULL,
+                        created_at INTEGER NOT NULL,
+                        expires_at INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS batches (
+                        batch_id TEXT PRIMARY KEY,
+                        total_inputs INTEGER NOT NULL,
+                        created_at INTEGER NOT NULL
+                    )
+                """)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache unavailable, running without it: {e}")
+            self.enabled = False
+    
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+    
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(f"{MODEL}|{SYSTEM_PROMPT_VERSION}|{text}".encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        """Return (components, usage) for a live entry, or None"""
+        if not self.enabled:
+            return None
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT components_json, usage_json FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, int(time.time()))
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        
+        if row is None:
+            return None
+        return orjson.loads(row[0]), orjson.loads(row[1])
+    
+    def set(self, key: str, components: list, usage: dict):
+        if not self.enabled:
+            return
+        now = int(time.time())
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, orjson.dumps(components), orjson.dumps(usage), now, now + self.ttl)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed: {e}")
+    
+    def record_batch(self, batch_id: str, total_inputs: int):
+        # The batch already exists upstream, so a failed write is logged rather than raised
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO batches VALUES (?, ?, ?)",
+                    (batch_id, total_inputs, int(time.time()))
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to record batch {batch_id}: {e}")
+    
+    def get_batch(self, batch_id: str):
+        """Return metadata for a batch submitted by this service, or None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT total_inputs, created_at FROM batches WHERE batch_id = ?", (batch_id,)
+            ).fetchone()
+        
+        if row is None:
+            return None
+        return {"total_inputs": row[0], "created_at": row[1]}
+    
+    def purge_expired(self) -> int:
+        """Delete expired entries and reclaim their disk space"""
+        with closing(self._connect()) as conn:
+            with conn:
+                deleted = conn.execute(
+                    "DELETE FROM responses WHERE expires_at <= ?", (int(time.time()),)
+                ).rowcount
+                # Semantic entries live in this database unless SEMANTIC_CACHE_PATH moves them
+                deleted += _purge_semantic_entries(conn)
+            conn.execute("VACUUM")
+        return deleted
+
+
+class SemanticCache:
+    """Embedding index over entries stored in SQLite, returning results for near-duplicate inputs"""
+    
+    def __init__(self, path: str, threshold: float, ttl: int, max_entries: int, refresh_interval: float = 30.0):
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.embeddings = None  # Preallocated rows; only the first self.size are live
+        self.expires = None
+        self.size = 0
+        self.results = []
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        
+        # Rows are appended to a shared table, so every gunicorn worker sees every entry
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(semantic_entries)")}
+                if columns and "expires_at" not in columns:
+                    # Pre-expiry schema; entries are disposable, so start over
+                    conn.execute("DROP TABLE semantic_entries")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS semantic_entries (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        namespace TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        components_json BLOB NOT NULL,
+                        usage_json BLOB NOT NULL,
+                        created_at INTEGER NOT NULL,
+                        expires_at INTEGER NOT NULL
+                    )
+                """)
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS semantic_entries_namespace ON semantic_entries (namespace, id)"
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Semantic cache unavailable, starting empty: {e}")
+            return
+        
+        self._refresh()
+        logger.info(f"Loaded {self.size} semantic cache entries")
+    
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+    
+    def _refresh(self):
+        """Load live entries added since the last refresh, by this or any other worker"""
+        with self.lock:
+            try:
+                with closing(self._connect()) as conn:
+                    # Newest first so the cap keeps the most recent entries
+                    rows = conn.execute(
+                        "SELECT id, embedding, components_json, usage_json, expires_at FROM semantic_entries "
+                        "WHERE namespace = ? AND id > ? AND expires_at > ? ORDER BY id DESC LIMIT ?",
+                        (SEMANTIC_NAMESPACE, self.last_id, int(time.time()), self.max_entries)
+                    ).fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Semantic cache read failed: {e}")
+                return
+            finally:
+                self.refreshed_at = time.monotonic()
+            
+            if not rows:
+                return
+            rows.reverse()
+            
+            if self.size + len(rows) > self.max_entries:
+                # Drop expired and oldest entries down to 3/4 of the cap, so this copy
+                # happens once per max_entries/4 additions rather than on every one
+                self._compact(max(self.max_entries * 3 // 4 - len(rows), 0))
+            
+            vecs = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            needed = self.size + len(rows)
+            if self.embeddings is None or needed > len(self.embeddings):
+                # Grow geometrically so appends don't copy the whole matrix each time
+                capacity = min(max(needed, 2 * self.size, 64), self.max_entries)
+                grown = np.empty((capacity, vecs.shape[1]), dtype=np.float32)
+                expires = np.empty(capacity, dtype=np.int64)
+                if self.size:
+                    grown[:self.size] = self.embeddings[:self.size]
+                    expires[:self.size] = self.expires[:self.size]
+                self.embeddings, self.expires = grown, expires
+            
+            # Rows past a reader's size snapshot are invisible to it, so this is safe in place
+            self.embeddings[self.size:needed] = vecs
+            self.expires[self.size:needed] = [row[4] for row in rows]
+            self.results.extend([orjson.loads(row[2]), orjson.loads(row[3])] for row in rows)
+            self.size = needed
+            self.last_id = rows[-1][0]
+    
+    def _compact(self, keep: int):
+        """Keep at most the newest `keep` live entries; builds new objects so readers' snapshots stay valid"""
+        live = np.flatnonzero(self.expires[:self.size] > int(time.time()))
+        live = live[len(live) - keep:] if keep else live[:0]
+        if len(live):
+            self.embeddings, self.expires = self.embeddings[live], self.expires[live]
+        else:
+            self.embeddings, self.expires = None, None
+        self.results = [self.results[i] for i in live]
+        self.size = len(live)
+    
+    def embed(self, text: str):
+        """Return the L2-normalized embedding of text, or None if it cannot be computed"""
+        try:
+            response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        except Exception as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+            return None
+        
+        vec = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else None
+    
+    def lookup(self, query: np.ndarray):
+        """Return (components, usage) of the most similar live entry above threshold, or None"""
+        if time.monotonic() - self.refreshed_at >= self.refresh_interval:
+            self._refresh()
+        
+        with self.lock:
+            embeddings, expires, size, results = self.embeddings, self.expires, self.size, self.results
+        
+        if size == 0:
+            return None
+        
+        # Rows and query are unit vectors, so one gemv gives cosine similarities
+        sims = embeddings[:size] @ query
+        # Entries expire with the response cache, so the semantic path can't outlive its TTL
+        sims[expires[:size] <= int(time.time())] = -np.inf
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        return results[best]
+    
+    def add(self, query: np.ndarray, components: list, usage: dict):
+        """Append one entry: a single-row insert rather than a rewrite of the index"""
+        now = int(time.time())
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT INTO semantic_entries "
+                    "(namespace, embedding, components_json, usage_json, created_at, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (SEMANTIC_NAMESPACE, query.astype(np.float32).tobytes(),
+                     orjson.dumps(components), orjson.dumps(usage), now, now + self.ttl)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Semantic cache write failed: {e}")
+            return
+        self._refresh()
+    
+    def purge_expired(self) -> int:
+        """Delete expired entries and those of other model/prompt versions"""
+        with closing(self._connect()) as conn:
+            with conn:
+                deleted = _purge_semantic_entries(conn)
+            conn.execute("VACUUM")
+        return deleted
+
+
+_HORIZONTAL_WS_RE = re.compile(r"[ \t]+")
+
+
+def _canonicalize(text: str) -> str:
+    """Normalize text so equivalent inputs produce byte-identical prompts and cache keys"""
+    text = unicodedata.normalize("NFC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\u00A0", " ")
+    return "\n".join(_HORIZONTAL_WS_RE.sub(" ", line).rstrip() for line in text.split("\n"))
+
+
+class RateLimiter:
+    """Thread-safe token bucket capping requests per minute"""
+    
+    def __init__(self, rpm: int, burst: int):
+        self.rate = rpm / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(OPENAI_RPM_LIMIT, burst=MAX_CONCURRENCY)
+_concurrency = threading.BoundedSemaphore(MAX_CONCURRENCY)
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+
+def _create_completion(**kwargs):
+    """Chat completion call bounded by the concurrency cap and rate limiter"""
+    with _concurrency:
+        rate_limiter.acquire()
+        return client.chat.completions.create(**kwargs)
+
+
+def _stream_completion(**kwargs):
+    """Streamed chat completion holding its concurrency slot until the stream is read or closed"""
+    with _concurrency:
+        rate_limiter.acquire()
+        with client.chat.completions.create(stream=True, **kwargs) as stream:
+            yield from stream
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_json_array(text: str):
+    """Return the first complete JSON array of objects embedded in text, or None"""
+    # raw_decode parses one value in a single pass and ignores trailing text
+    start = text.find("[")
+    while start != -1:
+        try:
+            value, _ = _JSON_DECODER.raw_decode(text, start)
+            # Skip bracketed prose such as "[3]" inside a string value
+            if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+                return value
+        except json.JSONDecodeError:
+            pass
+        start = text.find("[", start + 1)
+    return None
+
+
+class ComponentStreamParser:
+    """Incrementally yield complete objects from a streamed {"components": [...]} document"""
+    
+    def __init__(self):
+        self.buffer = ""
+        self.pos = None  # Index just inside the components array once found
+        self.done = False
+    
+    def feed(self, delta: str) -> list:
+        self.buffer += delta
+        if self.done:
+            return []
+        
+        if self.pos is None:
+            key = self.buffer.find('"components"')
+            start = self.buffer.find("[", key) if key != -1 else -1
+            if start == -1:
+                return []
+            self.pos = start + 1
+        elif "}" not in delta:
+            # An object can only have been completed by a closing brace
+            return []
+        
+        components = []
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos >= len(self.buffer):
+                break
+            if self.buffer[self.pos] == "]":
+                self.done = True
+                break
+            try:
+                component, self.pos = _JSON_DECODER.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                break  # Object still incomplete; wait for more text
+            components.append(component)
+        
+        return components
+
+
+def _normalize_components(value):
+    """Coerce a parsed model value to a list of component dicts, or None if it has no usable shape"""
+    if isinstance(value, dict):
+        if "components" in value:
+            value = value["components"]
+        elif "type" in value and "text" in value:
+            # A less obedient model may return a bare component object
+            value = [value]
+        else:
+            # {"error": ...}, {} and the like are not an answer
+            return None
+    if not isinstance(value, list):
+        return None
+    return [comp for comp in value if isinstance(comp, dict)]
+
+
+def _parse_components(result_text: str):
+    """Parse the model's {"components": [...]} JSON output; None if it cannot be parsed"""
+    try:
+        components = _normalize_components(orjson.loads(result_text))
+    except orjson.JSONDecodeError:
+        # JSON mode should make this unreachable; keep a last-resort extraction
+        components = _normalize_components(_extract_json_array(result_text))
+    return components
+
+
+def _usage_dict(usage) -> dict:
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens
+    }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL)
+semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES
+) if SEMANTIC_CACHE_ENABLED else None
+
+
+@app.cli.command("purge-cache")
+def purge_cache_command():
+    """Remove expired response cache entries (run from cron)"""
+    deleted = response_cache.purge_expired()
+    if semantic_cache is not None and SEMANTIC_CACHE_PATH != RESPONSE_CACHE_PATH:
+        deleted += semantic_cache.purge_expired()
+    print(f"Purged {deleted} expired cache entries")
+
+
 @app.route("/", methods=["GET"])
 def health_check():
     return jsonify({
         "status": "healthy",
         "service": "Clinical Component Identifier API",
         "model": MODEL,
+        "system_prompt_tokens": _SYS_TOKENS,
         "version": "1.0.0 (Few-Shot)"
     })
 
 
+def _identify_text(text: str, input_tokens: int):
+    """Return (components, usage, finish_reason) for text; components is None if unparseable"""
+    max_tokens = _max_output_tokens(input_tokens)
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    while True:
+        response = _create_completion(
+            model=MODEL,
+            messages=_STATIC_MESSAGES + [{"role": "user", "content": text}],
+            temperature=TEMPERATURE,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"},
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+        )
+        for key, value in _usage_dict(response.usage).items():
+            usage[key] += value
+        
+        finish_reason = response.choices[0].finish_reason
+        if finish_reason != "length" or max_tokens >= MAX_OUTPUT_TOKENS:
+            break
+        # The scaled budget was too tight (many components); retry once at the full budget
+        logger.warning(f"Completion hit max_tokens={max_tokens}; retrying with {MAX_OUTPUT_TOKENS}")
+        max_tokens = MAX_OUTPUT_TOKENS
+    
+    result_text = (response.choices[0].message.content or "").strip()
+    if finish_reason == "length":
+        # Cut-off JSON: keep the components that were complete before the cut
+        # (the generic fallback could latch onto a "[...]" inside a string)
+        components = [comp for comp in ComponentStreamParser().feed(result_text) if isinstance(comp, dict)]
+    else:
+        components = _parse_components(result_text)
+    return components, usage, finish_reason
+
+
 @app.route("/api/identify", methods=["POST"])
 def identify_components():
     try:
@@ -99,80 +773,556 @@ def identify_components():
         if not text:
             return jsonify({"error": "Text cannot be empty"}), 400
         
+        # Same bytes go to the cache key and to the API
+        text = _canonicalize(text)
+        
+        input_tokens = _count_tokens(text)
+        too_long = _input_too_long(input_tokens)
+        if too_long:
+            return too_long
+        
+        # Sampling is only deterministic enough to cache at temperature 0
+        cacheable = TEMPERATURE == 0.0
+        cache_key = ResponseCache.make_key(text)
+        
+        cached = response_cache.get(cache_key) if cacheable else None
+        if cached is not None:
+            components, usage = cached
+            return jsonify({
+                "success": True,
+                "components": components,
+                "total_components": len(components),
+                "model_used": MODEL,
+                "usage": usage,
+                "cached": True
+            })
+        
+        # Near-duplicate lookup costs one embedding call instead of a completion
+        query_embedding = None
+        if cacheable and semantic_cache is not None and input_tokens <= EMBEDDING_MAX_TOKENS:
+            query_embedding = semantic_cache.embed(text)
+            similar = semantic_cache.lookup(query_embedding) if query_embedding is not None else None
+            if similar is not None:
+                components, usage = similar
+                return jsonify({
+                    "success": True,
+                    "components": components,
+                    "total_components": len(components),
+                    "model_used": MODEL,
+                    "usage": usage,
+                    "cached": True
+                })
+        
         # Call OpenAI API
-        response = client.chat.completions.create(
+        components, usage, finish_reason = _identify_text(text, input_tokens)
+        
+        if components is None:
+            logger.error(f"Unparseable completion (finish_reason={finish_reason})")
+            return jsonify({
+                "success": False,
+                "error": "Model returned unparseable output",
+                "components": [],
+                "usage": usage
+            }), 502
+        
+        # Add component IDs
+        for i, comp in enumerate(components):
+            comp["component_id"] = f"comp_{i+1:03d}"
+        
+        # A cut-off answer must not look complete, and is never cached
+        if finish_reason != "stop":
+            return jsonify({
+                "success": False,
+                "error": f"Model output incomplete (finish_reason={finish_reason})",
+                "truncated": finish_reason == "length",
+                "components": components,
+                "total_components": len(components),
+                "model_used": MODEL,
+                "usage": usage
+            }), 502
+        
+        if cacheable:
+            response_cache.set(cache_key, components, usage)
+        if query_embedding is not None:
+            semantic_cache.add(query_embedding, components, usage)
+        
+        return jsonify({
+            "success": True,
+            "components": components,
+            "total_components": len(components),
+            "model_used": MODEL,
+            "usage": usage,
+            "cached": False
+        })
+        
+    except BadRequest:
+        return jsonify({"error": "Request body must be valid JSON"}), 400
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "components": []
+        }), 500
+
+
+def _identify_batch_chunk(offset: int, texts: list, token_counts: list):
+    """Identify components for consecutive batch inputs in a single API call"""
+    inputs = "\n---\n".join(f"INPUT {i}:\n{text}" for i, text in enumerate(texts))
+    user_message = (
+        f"Unlike the examples, this message contains {len(texts)} separate inputs. "
+        'Instead of {"components": [...]}, return a JSON object {"results": [...]} with exactly '
+        f"{len(texts)} entries, where results[i] is the JSON array of components for INPUT i.\n\n" + inputs
+    )
+    
+    try:
+        response = _create_completion(
             model=MODEL,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Identify all reusable components in this clinical text:\n\n{text}"}
-            ],
-            temperature=0.0,
-            max_tokens=4000
+            messages=_STATIC_MESSAGES + [{"role": "user", "content": user_message}],
+            temperature=TEMPERATURE,
+            max_tokens=min(BATCH_MAX_TOKENS, sum(_max_output_tokens(n) for n in token_counts)),
+            response_format={"type": "json_object"},
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
         )
+    except Exception as e:
+        # e.g. 429/timeout after the SDK's retries: fail this chunk's inputs, keep the other chunks
+        logger.error(f"Error: {str(e)}")
+        results = [
+            {"index": offset + i, "error": str(e), "components": [], "total_components": 0}
+            for i in range(len(texts))
+        ]
+        return results, {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    
+    usage = _usage_dict(response.usage)
+    
+    result_text = (response.choices[0].message.content or "").strip()
+    try:
+        parsed = orjson.loads(result_text)
+    except orjson.JSONDecodeError:
+        parsed = None
+    
+    if isinstance(parsed, dict) and "results" not in parsed and "components" in parsed and len(texts) == 1:
+        # A lone input may come back in the single-text {"components": [...]} shape
+        parsed = {"results": [parsed]}
+    raw_results = parsed.get("results", []) if isinstance(parsed, dict) else parsed
+    if not isinstance(raw_results, list) or response.choices[0].finish_reason != "stop":
+        raw_results = []
+    if len(raw_results) != len(texts):
+        logger.warning(f"Batch chunk returned {len(raw_results)} results for {len(texts)} inputs")
+    
+    results = []
+    for i in range(len(texts)):
+        index = offset + i
+        components = _normalize_components(raw_results[i]) if i < len(raw_results) else None
+        
+        if components is None:
+            # Missing or malformed entry: identify this input on its own
+            error = None
+            try:
+                components, single_usage, finish_reason = _identify_text(texts[i], token_counts[i])
+                for key in usage:
+                    usage[key] += single_usage[key]
+                if components is None or finish_reason != "stop":
+                    error = f"No complete result for this input (finish_reason={finish_reason})"
+            except Exception as e:
+                logger.error(f"Error: {str(e)}")
+                error = str(e)
+            
+            if error:
+                results.append({
+                    "index": index,
+                    "error": error,
+                    "components": [],
+                    "total_components": 0
+                })
+                continue
+        
+        for j, comp in enumerate(components):
+            comp["component_id"] = f"input_{index:03d}_comp_{j+1:03d}"
+        
+        results.append({
+            "index": index,
+            "components": components,
+            "total_components": len(components)
+        })
+    
+    return results, usage
+
+
+@app.route("/api/identify/stream", methods=["POST"])
+def identify_components_stream():
+    """Stream components as NDJSON lines while the model is still generating"""
+    try:
+        data = request.get_json()
+        
+        if not isinstance(data, dict) or "text" not in data:
+            return jsonify({"error": "Text field is required"}), 400
         
-        result_text = response.choices[0].message.content.strip()
+        if not isinstance(data["text"], str):
+            return jsonify({"error": "Text must be a string"}), 400
+        
+        text = data["text"].strip()
+        if not text:
+            return jsonify({"error": "Text cannot be empty"}), 400
+        
+        text = _canonicalize(text)
+        input_tokens = _count_tokens(text)
+        too_long = _input_too_long(input_tokens)
+        if too_long:
+            return too_long
+        
+        cacheable = TEMPERATURE == 0.0
+        cache_key = ResponseCache.make_key(text)
+        cached = response_cache.get(cache_key) if cacheable else None
+        
+    except BadRequest:
+        return jsonify({"error": "Request body must be valid JSON"}), 400
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+    
+    def generate():
+        if cached is not None:
+            components, usage = cached
+            for comp in components:
+                yield orjson.dumps({"component": comp}) + b"\n"
+            yield orjson.dumps({
+                "done": True,
+                "total_components": len(components),
+                "model_used": MODEL,
+                "usage": usage,
+                "cached": True
+            }) + b"\n"
+            return
         
-        # Parse JSON response
+        stream = _stream_completion(
+            model=MODEL,
+            messages=_STATIC_MESSAGES + [{"role": "user", "content": text}],
+            temperature=TEMPERATURE,
+            max_tokens=_max_output_tokens(input_tokens),
+            response_format={"type": "json_object"},
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+            stream_options={"include_usage": True}
+        )
         try:
-            # Remove markdown code blocks if present
-            if result_text.startswith("```"):
-                result_text = result_text.split("```")[1]
-                if result_text.startswith("json"):
-                    result_text = result_text[4:]
+            parser = ComponentStreamParser()
+            components = []
+            usage = None
+            finish_reason = None
+            for chunk in stream:
+                if chunk.usage:
+                    usage = _usage_dict(chunk.usage)
+                if not chunk.choices:
+                    continue
+                if chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if not chunk.choices[0].delta.content:
+                    continue
+                
+                for comp in parser.feed(chunk.choices[0].delta.content):
+                    # Same rule as _normalize_components: non-object items are dropped
+                    if not isinstance(comp, dict):
+                        continue
+                    comp["component_id"] = f"comp_{len(components)+1:03d}"
+                    components.append(comp)
+                    yield orjson.dumps({"component": comp}) + b"\n"
             
-            components = json.loads(result_text)
+            # A cut-off stream leaves a partial list; only cache a closed array
+            if cacheable and usage is not None and finish_reason == "stop" and parser.done:
+                response_cache.set(cache_key, components, usage)
             
-            if isinstance(components, dict):
-                components = components.get("components", [components])
+            done = {
+                "done": True,
+                "total_components": len(components),
+                "model_used": MODEL,
+                "usage": usage,
+                "cached": False
+            }
+            if finish_reason != "stop":
+                # Components already sent cannot be retried; flag the answer as partial
+                done.update({
+                    "success": False,
+                    "error": f"Model output incomplete (finish_reason={finish_reason})",
+                    "truncated": finish_reason == "length"
+                })
+            yield orjson.dumps(done) + b"\n"
             
-        except json.JSONDecodeError:
-            # Try to extract JSON array
-            import re
-            match = re.search(r'\[.*\]', result_text, re.DOTALL)
-            if match:
-                components = json.loads(match.group())
-            else:
-                components = []
+        except Exception as e:
+            logger.error(f"Error: {str(e)}")
+            yield orjson.dumps({"done": True, "success": False, "error": str(e)}) + b"\n"
+        finally:
+            # Releases the concurrency slot, also when the client disconnects mid-stream
+            stream.close()
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route("/api/identify_batch", methods=["POST"])
+def identify_components_batch():
+    """Identify components in several texts with a single API call"""
+    try:
+        data = request.get_json()
         
-        # Add component IDs
-        for i, comp in enumerate(components):
-            comp["component_id"] = f"comp_{i+1:03d}"
+        if not isinstance(data, dict) or not isinstance(data.get("texts"), list) or not data["texts"]:
+            return jsonify({"error": "Texts field must be a non-empty list"}), 400
+        
+        if len(data["texts"]) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} texts per batch"}), 400
+        
+        texts = []
+        token_counts = []
+        for i, text in enumerate(data["texts"]):
+            if not isinstance(text, str) or not text.strip():
+                return jsonify({"error": f"Text {i} cannot be empty"}), 400
+            texts.append(_canonicalize(text.strip()))
+            token_counts.append(_count_tokens(texts[-1]))
+        
+        # Chunks run concurrently; each pays the system prompt once
+        chunks = [
+            (offset, texts[offset:offset + BATCH_CHUNK_SIZE], token_counts[offset:offset + BATCH_CHUNK_SIZE])
+            for offset in range(0, len(texts), BATCH_CHUNK_SIZE)
+        ]
+        for _, _, counts in chunks:
+            too_long = _input_too_long(sum(counts))
+            if too_long:
+                return too_long
+        
+        chunk_results = list(_executor.map(lambda chunk: _identify_batch_chunk(*chunk), chunks))
+        
+        results = []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        for chunk_result, chunk_usage in chunk_results:
+            results.extend(chunk_result)
+            for key in usage:
+                usage[key] += chunk_usage[key]
         
         return jsonify({
             "success": True,
-            "components": components,
-            "total_components": len(components),
+            "results": results,
+            "total_inputs": len(texts),
+            "total_components": sum(r["total_components"] for r in results),
             "model_used": MODEL,
-            "usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
-            }
+            "usage": usage
         })
         
+    except BadRequest:
+        return jsonify({"error": "Request body must be valid JSON"}), 400
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         return jsonify({
             "success": False,
             "error": str(e),
-            "components": []
+            "results": []
+        }), 500
+
+
+@app.route("/api/identify_bulk", methods=["POST"])
+def identify_components_bulk():
+    """Submit texts to the OpenAI Batch API (half price, results within 24h)"""
+    try:
+        data = request.get_json()
+        
+        if not isinstance(data, dict) or not isinstance(data.get("texts"), list) or not data["texts"]:
+            return jsonify({"error": "Texts field must be a non-empty list"}), 400
+        
+        if len(data["texts"]) > MAX_BULK_SIZE:
+            return jsonify({"error": f"At most {MAX_BULK_SIZE} texts per bulk job"}), 400
+        
+        batch_input = BytesIO()
+        for i, text in enumerate(data["texts"]):
+            if not isinstance(text, str) or not text.strip():
+                return jsonify({"error": f"Text {i} cannot be empty"}), 400
+            
+            text = _canonicalize(text.strip())
+            input_tokens = _count_tokens(text)
+            too_long = _input_too_long(input_tokens)
+            if too_long:
+                return too_long
+            
+            batch_input.write(orjson.dumps({
+                "custom_id": f"row-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "messages": _STATIC_MESSAGES + [{"role": "user", "content": text}],
+                    "temperature": TEMPERATURE,
+                    "max_tokens": _max_output_tokens(input_tokens),
+                    "response_format": {"type": "json_object"},
+                    "prompt_cache_key": PROMPT_CACHE_KEY
+                }
+            }) + b"\n")
+            
+            if batch_input.tell() > BULK_FILE_MAX_BYTES:
+                return jsonify({
+                    "error": f"Bulk input exceeds {BULK_FILE_MAX_BYTES // (1024 * 1024)} MB at text {i}; split it into smaller jobs"
+                }), 413
+        
+        total_inputs = len(data["texts"])
+        batch_input.seek(0)
+        batch_file = client.files.create(
+            file=("identify_bulk.jsonl", batch_input),
+            purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        response_cache.record_batch(batch.id, total_inputs)
+        
+        return jsonify({
+            "success": True,
+            "batch_id": batch.id,
+            "status": batch.status,
+            "total_inputs": total_inputs
+        }), 202
+        
+    except BadRequest:
+        return jsonify({"error": "Request body must be valid JSON"}), 400
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route("/api/batch/<batch_id>", methods=["GET"])
+def get_bulk_results(batch_id):
+    """Poll a bulk job and return its components once it has completed"""
+    try:
+        metadata = response_cache.get_batch(batch_id)
+        if metadata is None:
+            return jsonify({"error": "Unknown batch ID"}), 404
+        
+        batch = client.batches.retrieve(batch_id)
+        result = {
+            "success": True,
+            "batch_id": batch_id,
+            "status": batch.status,
+            "total_inputs": metadata["total_inputs"]
+        }
+        
+        # A batch where every request failed completes with only an error file
+        if batch.status != "completed":
+            if batch.request_counts:
+                result["completed_inputs"] = batch.request_counts.completed
+                result["failed_inputs"] = batch.request_counts.failed
+            return jsonify(result)
+        
+        # Successful requests land in the output file, failed ones in the error file
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(client.files.content(file_id).content.splitlines())
+        
+        results = []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        for line in lines:
+            if not line.strip():
+                continue
+            
+            row = orjson.loads(line)
+            index = int(row["custom_id"].split("-", 1)[1])
+            body = (row.get("response") or {}).get("body") or {}
+            
+            if row.get("error") or "choices" not in body:
+                results.append({
+                    "index": index,
+                    "error": row.get("error") or body.get("error"),
+                    "components": [],
+                    "total_components": 0
+                })
+                continue
+            
+            for key in usage:
+                usage[key] += body.get("usage", {}).get(key, 0)
+            
+            if body["choices"][0].get("finish_reason") == "length":
+                results.append({
+                    "index": index,
+                    "error": "Model output truncated at max_tokens",
+                    "truncated": True,
+                    "components": [],
+                    "total_components": 0
+                })
+                continue
+            
+            components = _parse_components((body["choices"][0]["message"]["content"] or "").strip())
+            if components is None:
+                results.append({
+                    "index": index,
+                    "error": "Model returned unparseable output",
+                    "components": [],
+                    "total_components": 0
+                })
+                continue
+            
+            for j, comp in enumerate(components):
+                comp["component_id"] = f"input_{index:03d}_comp_{j+1:03d}"
+            
+            results.append({
+                "index": index,
+                "components": components,
+                "total_components": len(components)
+            })
+        
+        # Inputs that appear in neither file still get an entry
+        seen = {r["index"] for r in results}
+        for index in range(metadata["total_inputs"]):
+            if index not in seen:
+                results.append({
+                    "index": index,
+                    "error": "No result returned for this input",
+                    "components": [],
+                    "total_components": 0
+                })
+        
+        # Batch output lines are not guaranteed to be in input order
+        results.sort(key=lambda r: r["index"])
+        result.update({
+            "results": results,
+            "model_used": MODEL,
+            "usage": usage
+        })
+        return jsonify(result)
+        
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
         }), 500
 
 
+# Static, so serialized once; the ETag changes whenever the content does
+_TAXONOMY_BYTES = orjson.dumps({
+    "component_types": [
+        {"name": "boilerplate", "description": "Standard regulatory or administrative text"},
+        {"name": "definition", "description": "Precise definitions of terms or endpoints"},
+        {"name": "study_section", "description": "Study-specific methodology or procedures"},
+        {"name": "drug_info", "description": "Information about investigational product"},
+        {"name": "safety", "description": "Safety monitoring or reporting procedures"},
+        {"name": "procedure", "description": "Clinical or administrative procedures"}
+    ]
+})
+_TAXONOMY_ETAG = hashlib.sha256(_TAXONOMY_BYTES).hexdigest()[:16]
+
+
 @app.route("/api/taxonomy", methods=["GET"])
 def get_taxonomy():
-    return jsonify({
-        "component_types": [
-            {"name": "boilerplate", "description": "Standard regulatory or administrative text"},
-            {"name": "definition", "description": "Precise definitions of terms or endpoints"},
-            {"name": "study_section", "description": "Study-specific methodology or procedures"},
-            {"name": "drug_info", "description": "Information about investigational product"},
-            {"name": "safety", "description": "Safety monitoring or reporting procedures"},
-            {"name": "procedure", "description": "Clinical or administrative procedures"}
-        ]
-    })
+    response = Response(_TAXONOMY_BYTES, mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    response.set_etag(_TAXONOMY_ETAG)
+    # Answers If-None-Match with 304 Not Modified
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see render.yaml)
+    app.run(host="0.0.0.0", port=port, debug=os.environ.get("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -12,12 +12,15 @@ Usage:
 import os
 import json
 import time
+import random
 import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import orjson
 from openai import OpenAI
 
-# Initialize client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Initialize client (the SDK retries 429/5xx and honors Retry-After)
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=5)
 
 # Configuration
 CONFIG = {
@@ -33,6 +36,16 @@ CONFIG = {
 }
 
 
+# Stop scanning a training file after this many errors
+MAX_VALIDATION_ERRORS = 100
+
+# Files at least this large are validated across all CPU cores
+PARALLEL_VALIDATION_MIN_BYTES = 64 * 1024 * 1024
+
+# Files at least this large are uploaded in parts through the Uploads API
+CHUNKED_UPLOAD_MIN_BYTES = 256 * 1024 * 1024
+
+
 def validate_api_key():
     """Check if API key is set"""
     api_key = os.environ.get("OPENAI_API_KEY")
@@ -48,51 +61,111 @@ def validate_api_key():
     return True
 
 
-def validate_training_file(file_path: str) -> dict:
-    """Validate JSONL training file format"""
-    print(f"\n📋 Validating: {file_path}")
-    
-    if not os.path.exists(file_path):
-        return {"valid": False, "error": f"File not found: {file_path}"}
+def _validate_range(file_path: str, start: int, end: int) -> tuple:
+    """Validate the lines in a byte range of a JSONL file
     
+    Returns (lines_read, examples, errors, warnings, truncated) where errors
+    and warnings are (line_number, message) pairs numbered from the start
+    of the range.
+    """
     errors = []
     warnings = []
-    examples = []
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for i, line in enumerate(f, 1):
+    total = 0
+    lines = 0
+    truncated = False
+    
+    # Stream line by line so memory stays flat regardless of file size
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            lines += 1
+            i = lines
+            
+            if len(errors) > MAX_VALIDATION_ERRORS:
+                truncated = True
+                break
+            
             try:
-                data = json.loads(line)
-                examples.append(data)
+                data = orjson.loads(line)
+                total += 1
                 
                 # Check structure
                 if "messages" not in data:
-                    errors.append(f"Line {i}: Missing 'messages' key")
+                    errors.append((i, "Missing 'messages' key"))
                     continue
                 
                 messages = data["messages"]
                 
                 # Check message count
                 if len(messages) < 2:
-                    errors.append(f"Line {i}: Need at least 2 messages (user + assistant)")
+                    errors.append((i, "Need at least 2 messages (user + assistant)"))
                 
                 # Check roles
                 roles = [m.get("role") for m in messages]
                 if "assistant" not in roles:
-                    errors.append(f"Line {i}: Missing assistant message")
+                    errors.append((i, "Missing assistant message"))
                 
                 # Check content
                 for j, msg in enumerate(messages):
                     if not msg.get("content"):
-                        warnings.append(f"Line {i}, message {j}: Empty content")
+                        warnings.append((i, f"message {j}: Empty content"))
                 
-            except json.JSONDecodeError as e:
-                errors.append(f"Line {i}: Invalid JSON - {e}")
+            except orjson.JSONDecodeError as e:
+                errors.append((i, f"Invalid JSON - {e}"))
+    
+    return lines, total, errors, warnings, truncated
+
+
+def _split_line_ranges(file_path: str, parts: int) -> list:
+    """Split a file into byte ranges that start and end on line boundaries"""
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, 'rb') as f:
+        for k in range(1, parts):
+            f.seek(max(size * k // parts, bounds[-1]))
+            f.readline()  # Advance to the start of the next line
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def validate_training_file(file_path: str) -> dict:
+    """Validate JSONL training file format"""
+    print(f"\n📋 Validating: {file_path}")
+    
+    if not os.path.exists(file_path):
+        return {"valid": False, "error": f"File not found: {file_path}"}
+    
+    # Large files are validated in parallel, one newline-aligned byte range per CPU
+    workers = os.cpu_count() or 1
+    if os.path.getsize(file_path) >= PARALLEL_VALIDATION_MIN_BYTES and workers > 1:
+        ranges = _split_line_ranges(file_path, workers)
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            chunks = list(executor.map(_validate_range, [file_path] * len(ranges), *zip(*ranges)))
+    else:
+        chunks = [_validate_range(file_path, 0, os.path.getsize(file_path))]
+    
+    errors = []
+    warnings = []
+    total = 0
+    line_offset = 0
+    for lines, count, chunk_errors, chunk_warnings, truncated in chunks:
+        total += count
+        errors.extend(f"Line {line_offset + i}: {msg}" for i, msg in chunk_errors)
+        warnings.extend(f"Line {line_offset + i}, {msg}" for i, msg in chunk_warnings)
+        line_offset += lines
+        
+        if truncated or len(errors) > MAX_VALIDATION_ERRORS:
+            errors.append("... (truncated)")
+            break
     
     # Summary
     result = {
         "valid": len(errors) == 0,
-        "total_examples": len(examples),
+        "total_examples": total,
         "errors": errors[:10],  # First 10 errors
         "warnings": warnings[:5],
         "error_count": len(errors),
@@ -113,11 +186,21 @@ def upload_file(file_path: str, purpose: str = "fine-tune") -> str:
     """Upload a file to OpenAI"""
     print(f"\n📤 Uploading: {file_path}")
     
-    with open(file_path, "rb") as f:
-        response = client.files.create(
-            file=f,
+    if os.path.getsize(file_path) >= CHUNKED_UPLOAD_MIN_BYTES:
+        # Uploads API sends one 64 MB part at a time, so memory stays bounded
+        upload = client.uploads.upload_file_chunked(
+            file=Path(file_path),
+            mime_type="text/jsonl",
             purpose=purpose
         )
+        response = upload.file
+    else:
+        # A (name, file) tuple is streamed from disk by the multipart encoder
+        with open(file_path, "rb") as f:
+            response = client.files.create(
+                file=(os.path.basename(file_path), f),
+                purpose=purpose
+            )
     
     print(f"  ✅ Uploaded: {response.id}")
     print(f"     Filename: {response.filename}")
@@ -170,17 +253,23 @@ def check_job_status(job_id: str) -> dict:
     return status
 
 
-def wait_for_completion(job_id: str, poll_interval: int = 60):
-    """Wait for fine-tuning job to complete"""
+def wait_for_completion(job_id: str, poll_interval: float = 5, max_interval: float = 120):
+    """Wait for fine-tuning job to complete, backing off between status checks"""
     print(f"\n⏳ Waiting for job {job_id} to complete...")
-    print(f"   (Checking every {poll_interval} seconds)\n")
+    print(f"   (Checking every {poll_interval}-{max_interval} seconds)\n")
+    
+    interval = poll_interval
+    last_status = None
     
     while True:
         status = check_job_status(job_id)
         current_status = status["status"]
         
-        timestamp = time.strftime("%H:%M:%S")
-        print(f"[{timestamp}] Status: {current_status}")
+        # Only log transitions to keep hours-long waits readable
+        if current_status != last_status:
+            timestamp = time.strftime("%H:%M:%S")
+            print(f"[{timestamp}] Status: {current_status}")
+            last_status = current_status
         
         if current_status == "succeeded":
             print(f"\n🎉 Fine-tuning completed!")
@@ -197,8 +286,9 @@ def wait_for_completion(job_id: str, poll_interval: int = 60):
             print(f"\n⚠️ Fine-tuning was cancelled")
             return status
         
-        # Still running
-        time.sleep(poll_interval)
+        # Still running: back off with jitter, capped at max_interval
+        time.sleep(interval + random.uniform(0, interval * 0.1))
+        interval = min(interval * 1.5, max_interval)
 
 
 def list_fine_tuning_jobs(limit: int = 10):
@@ -5,11 +5,34 @@ Uses only built-in Python modules (no pandas required)
 
 import json
 import csv
+import re
 import os
 import random
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick  # optional: pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Buffered JSONL writes are flushed in chunks of this size
+WRITE_BUFFER_BYTES = 1 << 20
+
+# Smaller CSVs are processed in-process; pool startup would dominate
+PARALLEL_CSV_MIN_ROWS = 5000
+
+# Paragraph boundary in transcriptions; runs of blank lines count once
+_SPLIT_RE = re.compile(r'\n\n+')
+
 # Component taxonomy for labeling
 COMPONENT_TYPES = {
     "boilerplate": ["compliance", "regulatory", "gcp", "ich", "fda", "confidential", "agreement", "ethical"],
@@ -20,18 +43,48 @@ COMPONENT_TYPES = {
     "procedure": ["procedure", "assessment", "visit", "schedule", "measurement", "evaluation", "blood", "sample", "test"]
 }
 
+# Flat parallel views of the taxonomy for the classifier's inner loop
+_TYPE_NAMES = tuple(COMPONENT_TYPES)
+_KEYWORDS = tuple(
+    (kw, type_idx)
+    for type_idx, keywords in enumerate(COMPONENT_TYPES.values())
+    for kw in keywords
+)
+
 
+def _build_keyword_automaton():
+    """Aho-Corasick automaton over every taxonomy keyword, or None without pyahocorasick"""
+    if ahocorasick is None:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for kw, type_idx in _KEYWORDS:
+        automaton.add_word(kw, (kw, type_idx))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+
+@lru_cache(maxsize=8192)
 def classify_text(text):
-    """Classify text into component type based on keywords"""
+    """Classify text into component type based on keywords (memoized: boilerplate repeats across rows)"""
     text_lower = text.lower()
     
-    scores = {}
-    for comp_type, keywords in COMPONENT_TYPES.items():
-        score = sum(1 for kw in keywords if kw in text_lower)
-        scores[comp_type] = score
+    scores = [0] * len(_TYPE_NAMES)
+    if _KEYWORD_AUTOMATON is not None:
+        # Single pass over the text; a keyword scores once however often it appears
+        for _, type_idx in {hit for _, hit in _KEYWORD_AUTOMATON.iter(text_lower)}:
+            scores[type_idx] += 1
+    else:
+        for kw, type_idx in _KEYWORDS:
+            if kw in text_lower:
+                scores[type_idx] += 1
     
-    max_type = max(scores, key=scores.get)
-    return max_type if scores[max_type] > 0 else "study_section"
+    # Ties go to the earliest type, as with max() over the taxonomy dict
+    best = max(range(len(scores)), key=scores.__getitem__)
+    return _TYPE_NAMES[best] if scores[best] > 0 else "study_section"
 
 
 def estimate_reuse_potential(text, comp_type):
@@ -43,74 +96,135 @@ def estimate_reuse_potential(text, comp_type):
     return "medium"
 
 
-def create_training_example(text, components):
-    """Create a single training example in OpenAI format"""
-    
-    system_message = """You are an expert clinical documentation analyst. Identify reusable components in clinical documents.
+SYSTEM_MESSAGE = """You are an expert clinical documentation analyst. Identify reusable components in clinical documents.
 
 Return a JSON array of components with this structure:
 [{"type": "component_type", "title": "Descriptive title", "text": "Exact text", "confidence": 0.95, "reuse_potential": "high|medium|low", "rationale": "Why this is reusable"}]
 
 Component types: boilerplate, definition, study_section, drug_info, safety, procedure"""
 
-    user_message = f"Identify components in this clinical text:\n\n{text}"
-    
-    assistant_message = json.dumps(components)
-    
+# Shared by every example; serialization only reads it, so never mutate
+_SYSTEM_MSG_DICT = {"role": "system", "content": SYSTEM_MESSAGE}
+
+
+def _user_message(text):
+    """User turn for a clinical text"""
+    return {"role": "user", "content": f"Identify components in this clinical text:\n\n{text}"}
+
+
+def _wrap_example(user_msg, assistant_message):
+    """Training example around a user turn and already-serialized assistant content"""
     return {
         "messages": [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message},
+            _SYSTEM_MSG_DICT,
+            user_msg,
             {"role": "assistant", "content": assistant_message}
         ]
     }
 
 
-def process_csv_file(csv_path):
-    """Process CSV file using built-in csv module"""
-    examples = []
-    
+def create_training_example(text, components):
+    """Create a single training example in OpenAI format"""
+    return _wrap_example(_user_message(text), json.dumps(components))
+
+
+def _cell(row, index, default=''):
+    """Value at a resolved column index, or default when the column is missing"""
+    return row[index] if index is not None and index < len(row) else default
+
+
+def _iter_examples(rows):
+    """Yield a training example per (text, specialty) row"""
+    for text, specialty in rows:
+        # Split into paragraphs, stopping at the five we keep
+        paragraphs = []
+        for raw in _SPLIT_RE.split(text):
+            para = raw.strip()
+            if len(para) > 50:
+                paragraphs.append(para)
+                if len(paragraphs) == 5:
+                    break
+        
+        if not paragraphs:
+            paragraphs = [text[:1000]]
+        
+        # Create components
+        components = []
+        for i, para in enumerate(paragraphs):
+            comp_type = classify_text(para)
+            
+            component = {
+                "type": comp_type,
+                "title": f"{specialty} - Section {i+1}".strip(),
+                "text": para[:500],
+                "confidence": round(random.uniform(0.85, 0.98), 2),
+                "reuse_potential": estimate_reuse_potential(para, comp_type),
+                "rationale": f"Self-contained {comp_type} section"
+            }
+            components.append(component)
+        
+        if components:
+            yield create_training_example(text[:2000], components)
+
+
+def _process_rows(rows):
+    """Turn (text, specialty) rows into a list of training examples"""
+    return list(_iter_examples(rows))
+
+
+def _iter_csv_rows(csv_path):
+    """Yield (text, specialty) for each CSV row with enough text to use"""
     with open(csv_path, 'r', encoding='utf-8', errors='ignore') as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        
+        # Resolve column positions once instead of building a dict per row
+        columns = {name: i for i, name in enumerate(next(reader, []))}
+        transcription_col = columns.get('transcription')
+        description_col = columns.get('description')
+        text_col = columns.get('text')
+        specialty_col = columns.get('medical_specialty')
+        alt_specialty_col = columns.get('specialty')
         
         for row in reader:
             # Try different column names
-            text = row.get('transcription', '') or row.get('description', '') or row.get('text', '')
-            specialty = row.get('medical_specialty', '') or row.get('specialty', 'General')
+            text = _cell(row, transcription_col) or _cell(row, description_col) or _cell(row, text_col)
+            specialty = _cell(row, specialty_col) or _cell(row, alt_specialty_col, 'General')
             
             if not text or len(text) < 100:
                 continue
             
-            # Split into paragraphs
-            paragraphs = [p.strip() for p in text.split('\n\n') if p.strip() and len(p.strip()) > 50]
-            
-            if not paragraphs:
-                paragraphs = [text[:1000]]
-            
-            # Create components
-            components = []
-            for i, para in enumerate(paragraphs[:5]):
-                comp_type = classify_text(para)
-                
-                component = {
-                    "type": comp_type,
-                    "title": f"{specialty} - Section {i+1}".strip(),
-                    "text": para[:500],
-                    "confidence": round(random.uniform(0.85, 0.98), 2),
-                    "reuse_potential": estimate_reuse_potential(para, comp_type),
-                    "rationale": f"Self-contained {comp_type} section"
-                }
-                components.append(component)
-            
-            if components:
-                example = create_training_example(text[:2000], components)
-                examples.append(example)
+            yield text, specialty
+
+
+def iter_csv_examples(csv_path):
+    """Yield training examples from a CSV one row at a time"""
+    return _iter_examples(_iter_csv_rows(csv_path))
+
+
+def process_csv_file(csv_path, workers=1):
+    """Process CSV file using built-in csv module"""
+    rows = list(_iter_csv_rows(csv_path))
+    
+    if workers <= 1 or len(rows) < PARALLEL_CSV_MIN_ROWS:
+        return _process_rows(rows)
+    
+    # Classification is CPU-bound; a few chunks per worker keeps them evenly loaded
+    chunk_size = -(-len(rows) // (workers * 4))
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    
+    examples = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_examples in executor.map(_process_rows, chunks):
+            examples.extend(chunk_examples)
     
     return examples
 
 
-def create_synthetic_examples():
-    """Create synthetic training examples"""
+_CONF_SLOT = "__CONF__"
+
+
+def iter_synthetic_examples():
+    """Yield synthetic training examples"""
     
     synthetic_data = [
         {
@@ -181,53 +295,126 @@ def create_synthetic_examples():
         }
     ]
     
-    examples = []
-    
     # Create base examples
     for data in synthetic_data:
-        example = create_training_example(data["text"], data["components"])
-        examples.append(example)
+        yield create_training_example(data["text"], data["components"])
+    
+    # Only confidence varies, so build the user turn and serialize each base once,
+    # with a slot per confidence; variations share the user dict (read-only)
+    templates = []
+    for data in synthetic_data:
+        slotted = [dict(comp, confidence=_CONF_SLOT) for comp in data["components"]]
+        templates.append((_user_message(data["text"]), json.dumps(slotted).split(f'"{_CONF_SLOT}"')))
     
     # Duplicate with variations for more training data
     for _ in range(15):
-        for data in synthetic_data:
-            varied_components = []
-            for comp in data["components"]:
-                varied_comp = comp.copy()
-                varied_comp["confidence"] = round(random.uniform(0.85, 0.98), 2)
-                varied_components.append(varied_comp)
-            
-            example = create_training_example(data["text"], varied_components)
-            examples.append(example)
-    
-    return examples
+        for user_msg, parts in templates:
+            confidences = [str(round(random.uniform(0.85, 0.98), 2)) for _ in range(len(parts) - 1)]
+            assistant_message = parts[0] + "".join(c + part for c, part in zip(confidences, parts[1:]))
+            yield _wrap_example(user_msg, assistant_message)
+
+
+def create_synthetic_examples():
+    """Create synthetic training examples"""
+    return list(iter_synthetic_examples())
 
 
-def validate_jsonl(examples):
+def is_valid_example(ex, reparse=True):
+    """Check one training example; reparse=False trusts our own assistant JSON"""
+    try:
+        if "messages" not in ex:
+            return False
+        if len(ex["messages"]) != 3:
+            return False
+        if not all(m.get("content") for m in ex["messages"]):
+            return False
+        if reparse:
+            _loads(ex["messages"][2]["content"])
+        return True
+    except (ValueError, TypeError, AttributeError):
+        # JSONDecodeError (json and orjson) is a ValueError
+        return False
+
+
+def validate_jsonl(examples, reparse=True):
     """Validate training examples"""
-    valid = []
+    return [ex for ex in examples if is_valid_example(ex, reparse)]
+
+
+def _loads(data):
+    """Parse JSON, via orjson when installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _dumps(obj):
+    """Compact UTF-8 JSON bytes, via orjson when installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# Serialized line for examples built by _wrap_example, with the system turn pre-encoded
+_EXAMPLE_TEMPLATE = (
+    b'{"messages":[' + _dumps(_SYSTEM_MSG_DICT).replace(b'%', b'%%')
+    + b',{"role":"user","content":%b},{"role":"assistant","content":%b}]}'
+)
+
+
+def _dumps_example(example):
+    """JSONL line for one example"""
+    messages = example["messages"]
+    if orjson is None and messages[0] is _SYSTEM_MSG_DICT:
+        # stdlib json: skip re-escaping the shared system prompt (orjson is faster whole)
+        return _EXAMPLE_TEMPLATE % (_dumps(messages[1]["content"]), _dumps(messages[2]["content"]))
+    return _dumps(example)
+
+
+class JsonlWriter:
+    """Buffered JSONL output file"""
     
-    for ex in examples:
-        try:
-            if "messages" not in ex:
-                continue
-            if len(ex["messages"]) != 3:
-                continue
-            if not all(m.get("content") for m in ex["messages"]):
-                continue
-            json.loads(ex["messages"][2]["content"])
-            valid.append(ex)
-        except:
-            continue
+    def __init__(self, output_path):
+        self._f = open(output_path, 'wb')
+        self._buf = bytearray()
+        self.count = 0
+    
+    def write(self, example):
+        self._buf += _dumps_example(example)
+        self._buf += b'\n'
+        self.count += 1
+        if len(self._buf) >= WRITE_BUFFER_BYTES:
+            self._f.write(self._buf)
+            self._buf.clear()
+    
+    def close(self):
+        self._f.write(self._buf)
+        self._f.close()
+    
+    def __enter__(self):
+        return self
     
-    return valid
+    def __exit__(self, *exc):
+        self.close()
 
 
 def save_jsonl(examples, output_path):
     """Save to JSONL file"""
-    with open(output_path, 'w', encoding='utf-8') as f:
+    with JsonlWriter(output_path) as writer:
         for example in examples:
-            f.write(json.dumps(example) + '\n')
+            writer.write(example)
+
+
+def save_streaming_split(examples, train_path, val_path, train_split, reparse=True):
+    """Validate and route each example to train or validation as it arrives; returns (valid, total, train, val) counts"""
+    valid = total = 0
+    with JsonlWriter(train_path) as train_f, JsonlWriter(val_path) as val_f:
+        for ex in examples:
+            total += 1
+            if not is_valid_example(ex, reparse):
+                continue
+            valid += 1
+            # Bernoulli split: proportions match train_split in expectation
+            (train_f if random.random() < train_split else val_f).write(ex)
+    return valid, total, train_f.count, val_f.count
 
 
 def main():
@@ -236,12 +423,36 @@ def main():
     parser.add_argument('--output', type=str, default='data', help='Output directory')
     parser.add_argument('--synthetic-only', action='store_true', help='Use only synthetic data')
     parser.add_argument('--train-split', type=float, default=0.8, help='Training split ratio')
+    parser.add_argument('--skip-revalidation', action='store_true', help='Skip re-parsing generated assistant JSON')
+    parser.add_argument('--stream', action='store_true',
+                        help='Constant-memory mode: split on the fly, without shuffling or an exact ratio')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes for CSV extraction')
     
     args = parser.parse_args()
     
     # Create output directory
     os.makedirs(args.output, exist_ok=True)
     
+    train_path = os.path.join(args.output, 'training_data.jsonl')
+    val_path = os.path.join(args.output, 'validation_data.jsonl')
+    
+    if args.stream:
+        # Never holds more than one example; file order follows generation order
+        sources = [iter_synthetic_examples()]
+        if args.input and not args.synthetic_only:
+            print(f"Streaming CSV file: {args.input}")
+            sources.append(iter_csv_examples(args.input))
+        
+        valid, total, n_train, n_val = save_streaming_split(
+            chain.from_iterable(sources), train_path, val_path,
+            args.train_split, reparse=not args.skip_revalidation
+        )
+        print(f"  Valid: {valid} / {total}")
+        print(f"\nSaved:")
+        print(f"  Training: {train_path} ({n_train} examples)")
+        print(f"  Validation: {val_path} ({n_val} examples)")
+        return
+    
     examples = []
     
     # Add synthetic examples
@@ -253,31 +464,26 @@ def main():
     # Process CSV if provided
     if args.input and not args.synthetic_only:
         print(f"Processing CSV file: {args.input}")
-        csv_examples = process_csv_file(args.input)
+        csv_examples = process_csv_file(args.input, workers=args.workers)
         examples.extend(csv_examples)
         print(f"  Extracted {len(csv_examples)} examples from CSV")
     
     # Validate
     print("\nValidating examples...")
-    valid_examples = validate_jsonl(examples)
+    valid_examples = validate_jsonl(examples, reparse=not args.skip_revalidation)
     print(f"  Valid: {len(valid_examples)} / {len(examples)}")
     
-    # Shuffle and split
+    # Shuffle in place and split
     random.shuffle(valid_examples)
     split_idx = int(len(valid_examples) * args.train_split)
-    train = valid_examples[:split_idx]
-    val = valid_examples[split_idx:]
-    
-    # Save
-    train_path = os.path.join(args.output, 'training_data.jsonl')
-    val_path = os.path.join(args.output, 'validation_data.jsonl')
     
-    save_jsonl(train, train_path)
-    save_jsonl(val, val_path)
+    # Save, streaming each side of the split without copying it out
+    save_jsonl(islice(valid_examples, split_idx), train_path)
+    save_jsonl(islice(valid_examples, split_idx, None), val_path)
     
     print(f"\nSaved:")
-    print(f"  Training: {train_path} ({len(train)} examples)")
-    print(f"  Validation: {val_path} ({len(val)} examples)")
+    print(f"  Training: {train_path} ({split_idx} examples)")
+    print(f"  Validation: {val_path} ({len(valid_examples) - split_idx} examples)")
 
 
 if __name__ == "__main__":